@@ -1,7 +1,7 @@
 import json
 import pandas as pd
 from bs4 import BeautifulSoup
-from typing import List
+from typing import Dict, List, Optional
 from tqdm import tqdm
 
 from funda_scraper.config.core import config
@@ -20,9 +20,21 @@ class DataExtractor(object):
         self.file_repo = FileRepository()
 
     def extract_data(
-        self, search_request: SearchRequest, run_id: str, clean_data: bool
+        self,
+        search_request: SearchRequest,
+        run_id: str,
+        clean_data: bool,
+        detail_pages: Optional[Dict[int, str]] = None,
+        save: bool = True,
     ) -> pd.DataFrame:
-        detail_pages = self.file_repo.get_detail_pages(run_id)
+        """Extracts the houses from the detail pages of a run.
+
+        The pages are read from the file repository unless they are passed in
+        as ``detail_pages``. The result is only written back when ``save`` is
+        ``True``.
+        """
+        if detail_pages is None:
+            detail_pages = self.file_repo.get_detail_pages(run_id)
 
         houses: list[Property] = []
 
@@ -72,7 +84,8 @@ class DataExtractor(object):
             df = preprocess_data(df=self.raw_df, is_past=search_request.find_sold)
             self.clean_df = df
 
-        self.file_repo.save_result_file(df, run_id)
+        if save:
+            self.file_repo.save_result_file(df, run_id)
 
         return df
 
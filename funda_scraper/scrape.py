@@ -1,24 +1,299 @@
 """Main funda scraper module"""
 
 import argparse
-import json
-import multiprocessing as mp
+import asyncio
+import threading
+import time
 import uuid
-from collections import OrderedDict
-from typing import List
-from urllib.parse import urlparse, urlunparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional
+from urllib.parse import quote, urlencode
 
+import httpx
+import orjson
 import pandas as pd
-import requests
-from bs4 import BeautifulSoup
+from lxml import etree
 from tqdm import tqdm
-from tqdm.contrib.concurrent import process_map
+from tqdm.asyncio import tqdm_asyncio
 
 from funda_scraper.config.core import config
 from funda_scraper.utils import logger
 from funda_scraper.extract import DataExtractor
 from funda_scraper.filerepository import FileRepository
-from funda_scraper.searchrequest import SearchRequest
+from funda_scraper.searchrequest import QuerySignature, SearchRequest
+
+# Fetching is I/O bound: the crawl runs on a single event loop that keeps up to
+# MAX_CONCURRENT_REQUESTS requests in flight, multiplexed over a small pool of
+# HTTP/2 connections.
+POOL_SIZE = 32
+MAX_CONCURRENT_REQUESTS = POOL_SIZE
+CHUNK_SIZE = 8192
+RETRIES = 3
+BACKOFF_FACTOR = 0.3
+POOL_LIMITS = httpx.Limits(
+    max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE
+)
+# Slow pages should not be dropped, and waiting for a free connection is
+# already bounded by the semaphore.
+TIMEOUT = httpx.Timeout(30, pool=None)
+
+# httpx advertises brotli next to gzip and deflate whenever the brotli decoder
+# is installed, so the clients keep its default Accept-Encoding header.
+
+_SESSION: Optional[httpx.Client] = None
+
+
+def _get_session() -> httpx.Client:
+    """Returns the shared HTTP client, creating it on first use.
+
+    All requests go to the same host, so reusing keep-alive connections saves a
+    TCP and TLS handshake per page. The client backs the synchronous helpers;
+    the crawl itself uses an ``httpx.AsyncClient``, see :meth:`FundaScraper.run`.
+    """
+    global _SESSION
+    if _SESSION is None:
+        transport = httpx.HTTPTransport(http2=True, limits=POOL_LIMITS)
+        _SESSION = httpx.Client(
+            transport=transport,
+            headers=config.header,
+            timeout=TIMEOUT,
+            follow_redirects=True,
+        )
+    return _SESSION
+
+
+# The JSON-LD block of a search page is located with plain substring searches;
+# lxml is only used for pages where that fails.
+_JSON_LD_MARKER = b'application/ld+json"'
+_SCRIPT_END = b"</script>"
+
+_thread_local = threading.local()
+
+
+def _get_html_parser() -> etree.HTMLParser:
+    """Returns the HTML parser of the current thread, creating it on first use.
+
+    Building a parser is not free and lxml parsers must not be used from two
+    threads at once, so each thread keeps one around for the fallback path.
+    """
+    parser = getattr(_thread_local, "html_parser", None)
+    if parser is None:
+        parser = etree.HTMLParser(recover=True, encoding="utf-8")
+        _thread_local.html_parser = parser
+    return parser
+
+
+class _ListPageLinkParser(object):
+    """Incrementally scans a search page and collects its property links.
+
+    Chunks are fed as they arrive from the network, so the links are known as
+    soon as the JSON-LD script has been read instead of after the full body.
+    With ``keep_page`` the whole page is buffered so it can be saved as well.
+    """
+
+    def __init__(self, keep_page: bool = False) -> None:
+        self._keep_page = keep_page
+        self._buffer = bytearray()
+        self._marker = -1
+        self._json_start = -1
+        self._search_from = 0
+        self.links: Optional[List[str]] = None
+
+    def feed(self, chunk: bytes) -> Optional[List[str]]:
+        """Feeds a chunk of the page, returning the links once they are found."""
+        if self.links is None or self._keep_page:
+            self._buffer += chunk
+        if self.links is None:
+            self._scan()
+        return self.links
+
+    @property
+    def page(self) -> bytes:
+        """The buffered page; only complete when created with ``keep_page``."""
+        return bytes(self._buffer)
+
+    def close(self) -> List[str]:
+        """Finishes parsing and returns the links of the page."""
+        if self.links is None:
+            tree = etree.fromstring(bytes(self._buffer), _get_html_parser())
+            # An empty or comment-only body parses to no tree at all.
+            scripts = (
+                []
+                if tree is None
+                else tree.xpath('//script[@type="application/ld+json"]/text()')
+            )
+            if not scripts:
+                raise ValueError("No JSON-LD script found on the search page.")
+            self._read_links(str(scripts[0]))
+        return self.links
+
+    def _scan(self) -> None:
+        buffer = self._buffer
+
+        while self.links is None:
+            if self._json_start < 0:
+                marker = buffer.find(_JSON_LD_MARKER, self._search_from)
+                if marker < 0:
+                    self._search_from = max(
+                        0, len(buffer) - len(_JSON_LD_MARKER) + 1
+                    )
+                    return
+                tag_end = buffer.find(b">", marker)
+                if tag_end < 0:
+                    self._search_from = marker
+                    return
+                self._marker = marker
+                self._json_start = self._search_from = tag_end + 1
+
+            json_end = buffer.find(_SCRIPT_END, self._search_from)
+            if json_end < 0:
+                self._search_from = max(
+                    self._json_start, len(buffer) - len(_SCRIPT_END) + 1
+                )
+                return
+
+            try:
+                self._read_links(buffer[self._json_start : json_end])
+            except (ValueError, KeyError, TypeError):
+                # The marker was not the JSON-LD script tag, e.g. it sits in an
+                # inline script, so look for the next one.
+                self._json_start = -1
+                self._search_from = self._marker + len(_JSON_LD_MARKER)
+
+        if not self._keep_page:
+            self._buffer = bytearray()
+
+    def _read_links(self, script: bytes | str) -> None:
+        json_data = orjson.loads(script)
+        self.links = [item["url"] for item in json_data["itemListElement"]]
+
+
+def _backoff(attempt: int) -> float:
+    """Seconds to wait before retrying after the given failed attempt."""
+    return BACKOFF_FACTOR * 2**attempt
+
+
+def _scrape_one_link(link: str, session: httpx.Client) -> str:
+    """Fetches a single page with a synchronous session."""
+    for attempt in range(RETRIES + 1):
+        try:
+            return session.get(link).text
+        except httpx.TransportError:
+            if attempt == RETRIES:
+                raise
+            time.sleep(_backoff(attempt))
+
+
+async def _scrape_one_link_async(
+    link: str, session: httpx.AsyncClient, semaphore: asyncio.Semaphore
+) -> str:
+    """Fetches a single page, bounded by the shared semaphore."""
+    for attempt in range(RETRIES + 1):
+        try:
+            async with semaphore:
+                response = await session.get(link)
+            return response.text
+        except httpx.TransportError:
+            if attempt == RETRIES:
+                raise
+            await asyncio.sleep(_backoff(attempt))
+
+
+async def _fetch_list_page(
+    session: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    url: str,
+    link_queue: asyncio.Queue,
+    keep_page: bool = False,
+) -> Optional[str]:
+    """Streams a search page, retrying on connection and read errors.
+
+    Links queued by a failed attempt are queued again by the retry; the
+    detail stage drops the duplicates.
+    """
+    for attempt in range(RETRIES + 1):
+        try:
+            return await _stream_list_page(
+                session, semaphore, url, link_queue, keep_page
+            )
+        except httpx.TransportError:
+            if attempt == RETRIES:
+                raise
+            await asyncio.sleep(_backoff(attempt))
+
+
+async def _stream_list_page(
+    session: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    url: str,
+    link_queue: asyncio.Queue,
+    keep_page: bool,
+) -> Optional[str]:
+    """Streams a search page, queueing its links as soon as they are parsed.
+
+    Reading stops once the links are found, unless ``keep_page`` asks for the
+    full page, which is then returned.
+    """
+    parser = _ListPageLinkParser(keep_page)
+    queued = False
+    async with semaphore:
+        async with session.stream("GET", url) as response:
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                links = parser.feed(chunk)
+                if links is not None and not queued:
+                    link_queue.put_nowait(links)
+                    queued = True
+                    if not keep_page:
+                        break
+            encoding = response.encoding
+    if not queued:
+        link_queue.put_nowait(parser.close())
+    if keep_page:
+        return parser.page.decode(encoding, errors="replace")
+    return None
+
+
+@lru_cache(maxsize=32)
+def _build_main_query_url(base_url: str, signature: QuerySignature) -> str:
+    """Constructs the main query URL for a search.
+
+    The URL only depends on ``SearchRequest.query_signature``, so it is built
+    once per distinct signature and shared by every scraper searching for it.
+    """
+    query = "koop" if signature.to_buy else "huur"
+
+    params = {"selected_area": f'["{signature.area}"]'}
+
+    if signature.property_type:
+        property_types = signature.property_type.split(",")
+        formatted_property_types = [f'"{prop_type}"' for prop_type in property_types]
+        params["object_type"] = f"[{','.join(formatted_property_types)}]"
+
+    if signature.find_sold:
+        params["availability"] = '["unavailable"]'
+
+    if signature.min_price is not None or signature.max_price is not None:
+        min_price = "" if signature.min_price is None else signature.min_price
+        max_price = "" if signature.max_price is None else signature.max_price
+        params["price"] = f'"{min_price}-{max_price}"'
+
+    if signature.days_since is not None:
+        params["publication_date"] = signature.days_since
+
+    if signature.min_floor_area or signature.max_floor_area:
+        min_floor_area = (
+            "" if signature.min_floor_area is None else signature.min_floor_area
+        )
+        max_floor_area = (
+            "" if signature.max_floor_area is None else signature.max_floor_area
+        )
+        params["floor_area"] = f'"{min_floor_area}-{max_floor_area}"'
+
+    if signature.sort is not None:
+        params["sort"] = f'"{signature.sort}"'
+
+    return f"{base_url}/zoeken/{query}?{urlencode(params, safe=',', quote_via=quote)}"
 
 
 class FundaScraper(object):
@@ -52,6 +327,11 @@ class FundaScraper(object):
         self.file_repo = FileRepository()
         self.data_extractor = DataExtractor()
 
+        # Fetched pages are kept in memory, keyed by page index, and only
+        # written to the file repository when a run is saved.
+        self._list_page_cache: Dict[int, str] = {}
+        self._detail_page_cache: Dict[int, str] = {}
+
     def __repr__(self):
         return str(self.search_request)
 
@@ -107,8 +387,27 @@ class FundaScraper(object):
     def reset(self, **kwargs) -> None:
         self.search_request.reset(**kwargs)
 
-    def _get_list_pages(
-        self, page_start: int = None, number_of_pages: int = None
+    async def _get_list_page(
+        self,
+        session: httpx.AsyncClient,
+        semaphore: asyncio.Semaphore,
+        link_queue: asyncio.Queue,
+        index: int,
+        url: str,
+        save: bool,
+    ) -> None:
+        page = await _fetch_list_page(session, semaphore, url, link_queue, save)
+        if save:
+            self._list_page_cache[index] = page
+
+    async def _get_list_pages(
+        self,
+        session: httpx.AsyncClient,
+        semaphore: asyncio.Semaphore,
+        link_queue: asyncio.Queue,
+        page_start: int = None,
+        number_of_pages: int = None,
+        save: bool = False,
     ) -> None:
         page_start = (
             self.search_request.page_start if page_start is None else page_start
@@ -119,130 +418,202 @@ class FundaScraper(object):
             else number_of_pages
         )
 
-        main_url = self._build_main_query_url()
-
-        for i in tqdm(range(page_start, page_start + number_of_pages)):
-            url = f"{main_url}&search_result={i}"
-            response = requests.get(url, headers=config.header)
-            self.file_repo.save_list_page(response.text, i, self.run_id)
-
-        return
-
-    def _get_detail_pages(self):
-        urls = []
-
-        list_pages = self.file_repo.get_list_pages(self.run_id)
-
-        for page in list_pages:
-            soup = BeautifulSoup(page, "lxml")
-            script_tag = soup.find_all("script", {"type": "application/ld+json"})[0]
-            json_data = json.loads(script_tag.contents[0])
-            item_list = [item["url"] for item in json_data["itemListElement"]]
-            urls += item_list
-
-        urls = self.remove_duplicates(urls)
-        fixed_urls = [self.fix_link(url) for url in urls]
+        main_url = self.main_query_url
+        logger.info(f"*** Main URL: {main_url} ***")
 
-        pools = mp.cpu_count()
-        content = process_map(self.scrape_one_link, fixed_urls, max_workers=pools)
+        tasks = [
+            asyncio.create_task(
+                self._get_list_page(
+                    session,
+                    semaphore,
+                    link_queue,
+                    i,
+                    f"{main_url}&search_result={i}",
+                    save,
+                )
+            )
+            for i in range(page_start, page_start + number_of_pages)
+        ]
+        try:
+            await tqdm_asyncio.gather(*tasks, desc="Fetching list pages..")
+        finally:
+            # A failed page aborts the run; stop the others before the client
+            # they are using is closed.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _queue_detail_pages(
+        self,
+        link_queue: asyncio.Queue,
+        detail_queue: asyncio.Queue,
+        detail_links: Dict[str, str],
+        progress: tqdm,
+    ) -> None:
+        """Deduplicates the links found on list pages and queues their details.
 
-        for i, c in enumerate(content):
-            self.file_repo.save_detail_page(c, i, self.run_id)
+        ``detail_links`` maps every link seen so far to its fixed form, so it
+        both filters duplicates and numbers the detail pages in one pass.
+        """
+        while True:
+            links = await link_queue.get()
+            try:
+                for link in links:
+                    if link in detail_links:
+                        continue
+                    try:
+                        fixed_link = self.fix_link(link)
+                    except Exception as e:
+                        logger.error(
+                            f"An error occurred while fixing {link}: {e}; "
+                            "skipping this page"
+                        )
+                        continue
+                    detail_queue.put_nowait((len(detail_links), fixed_link))
+                    detail_links[link] = fixed_link
+                    progress.total += 1
+                    progress.refresh()
+            finally:
+                link_queue.task_done()
+
+    async def _get_detail_pages(
+        self,
+        session: httpx.AsyncClient,
+        semaphore: asyncio.Semaphore,
+        detail_queue: asyncio.Queue,
+        progress: tqdm,
+    ) -> None:
+        """Fetches queued detail pages until cancelled."""
+        while True:
+            index, link = await detail_queue.get()
+            try:
+                self._detail_page_cache[index] = await _scrape_one_link_async(
+                    link, session, semaphore
+                )
+            except Exception as e:
+                logger.error(
+                    f"An error occurred while fetching {link}: {e}; skipping this page"
+                )
+            finally:
+                progress.update()
+                detail_queue.task_done()
 
     def scrape_one_link(self, link: str) -> str:
-        response = requests.get(link, headers=config.header)
-        return response.text
+        return _scrape_one_link(link, _get_session())
 
     @staticmethod
     def _get_links_from_one_parent(url: str) -> List[str]:
         """Scrapes all available property links from a single Funda search page."""
-        response = requests.get(url, headers=config.header)
-        soup = BeautifulSoup(response.text, "lxml")
-
-        script_tag = soup.find_all("script", {"type": "application/ld+json"})[0]
-        json_data = json.loads(script_tag.contents[0])
-        urls = [item["url"] for item in json_data["itemListElement"]]
-        return urls
+        for attempt in range(RETRIES + 1):
+            parser = _ListPageLinkParser()
+            try:
+                with _get_session().stream("GET", url) as response:
+                    for chunk in response.iter_bytes(CHUNK_SIZE):
+                        if parser.feed(chunk) is not None:
+                            break
+                return parser.close()
+            except httpx.TransportError:
+                if attempt == RETRIES:
+                    raise
+                time.sleep(_backoff(attempt))
 
     @staticmethod
     def remove_duplicates(lst: List[str]) -> List[str]:
         """Removes duplicate links from a list."""
-        return list(OrderedDict.fromkeys(lst))
+        return list(dict.fromkeys(lst))
 
     @staticmethod
     def fix_link(link: str) -> str:
         """Fixes a given property link to ensure proper URL formatting."""
-        link_url = urlparse(link)
-        link_path = link_url.path.split("/")
-        property_id = link_path.pop(5)
-        property_address = link_path.pop(4).split("-")
-        link_path = link_path[2:4]
-        property_address.insert(1, property_id)
-        link_path.extend(["-".join(property_address), "?old_ldp=true"])
-        fixed_link = urlunparse(
-            (link_url.scheme, link_url.netloc, "/".join(link_path), "", "", "")
+        # Detail links look like ``<scheme>//<host>/detail/<offer>/<city>/
+        # <kind>-<street>/<id>/`` and become ``.../<kind>-<id>-<street>/``.
+        scheme, _, host, path = link.split("/", 3)
+        _, offer, city, address, rest = path.split("/", 4)
+        kind, sep, street = address.partition("-")
+        property_id = rest.split("/", 1)[0].split("?", 1)[0]
+        return (
+            f"{scheme}//{host}/{offer}/{city}/"
+            f"{kind}-{property_id}{sep}{street}/?old_ldp=true"
         )
-        return fixed_link
-
-    def _build_main_query_url(self) -> str:
-        """Constructs the main query URL for the search."""
-        query = "koop" if self.search_request.to_buy else "huur"
-
-        main_url = f"{self.base_url}/zoeken/{query}?selected_area=%5B%22{self.search_request.area}%22%5D"
-
-        if self.search_request.property_type:
-            property_types = self.search_request.property_type.split(",")
-            formatted_property_types = [
-                "%22" + prop_type + "%22" for prop_type in property_types
-            ]
-            main_url += f"&object_type=%5B{','.join(formatted_property_types)}%5D"
-
-        if self.search_request.find_sold:
-            main_url = f'{main_url}&availability=%5B"unavailable"%5D'
-
-        if (
-            self.search_request.min_price is not None
-            or self.search_request.max_price is not None
-        ):
-            min_price = (
-                ""
-                if self.search_request.min_price is None
-                else self.search_request.min_price
-            )
-            max_price = (
-                ""
-                if self.search_request.max_price is None
-                else self.search_request.max_price
-            )
-            main_url = f"{main_url}&price=%22{min_price}-{max_price}%22"
-
-        if self.search_request.days_since is not None:
-            main_url = (
-                f"{main_url}&publication_date={self.search_request.check_days_since}"
-            )
-
-        if self.search_request.min_floor_area or self.search_request.max_floor_area:
-            min_floor_area = (
-                ""
-                if self.search_request.min_floor_area is None
-                else self.search_request.min_floor_area
-            )
-            max_floor_area = (
-                ""
-                if self.search_request.max_floor_area is None
-                else self.search_request.max_floor_area
-            )
-            main_url = f"{main_url}&floor_area=%22{min_floor_area}-{max_floor_area}%22"
 
-        if self.search_request.sort is not None:
-            main_url = f"{main_url}&sort=%22{self.search_request.sort_by}%22"
+    @property
+    def main_query_url(self) -> str:
+        """The main query URL for the search."""
+        return _build_main_query_url(self.base_url, self.search_request.query_signature)
 
-        logger.info(f"*** Main URL: {main_url} ***")
-        return main_url
+    async def _get_pages_async(self, save: bool = False) -> None:
+        """Fetches list and detail pages as one pipeline.
 
-    def _get_pages(self):
-        self._get_list_pages()
-        self._get_detail_pages()
+        List pages are streamed and parsed as they arrive; their links are
+        deduplicated and handed to a pool of detail workers straight away, so
+        detail pages download while later list pages are still in flight. List
+        pages are only read in full and kept when they are going to be saved.
+        """
+        transport = httpx.AsyncHTTPTransport(http2=True, limits=POOL_LIMITS)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        link_queue: asyncio.Queue = asyncio.Queue()
+        detail_queue: asyncio.Queue = asyncio.Queue()
+        detail_links: Dict[str, str] = {}
+        self._list_page_cache = {}
+        self._detail_page_cache = {}
+
+        async with httpx.AsyncClient(
+            transport=transport,
+            headers=config.header,
+            timeout=TIMEOUT,
+            follow_redirects=True,
+        ) as session:
+            with tqdm(total=0, desc="Fetching detail pages..") as progress:
+                tasks = [
+                    asyncio.create_task(
+                        self._queue_detail_pages(
+                            link_queue, detail_queue, detail_links, progress
+                        )
+                    )
+                ]
+                tasks += [
+                    asyncio.create_task(
+                        self._get_detail_pages(
+                            session, semaphore, detail_queue, progress
+                        )
+                    )
+                    for _ in range(MAX_CONCURRENT_REQUESTS)
+                ]
+                try:
+                    await self._get_list_pages(
+                        session, semaphore, link_queue, save=save
+                    )
+                    await link_queue.join()
+                    await detail_queue.join()
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Detail pages are numbered in the order their links were queued; keep
+        # the links whose page was fetched.
+        self.links = [
+            link
+            for i, link in enumerate(detail_links.values())
+            if i in self._detail_page_cache
+        ]
+
+    def _save_pages(self) -> None:
+        for i, page in self._list_page_cache.items():
+            self.file_repo.save_list_page(page, i, self.run_id)
+        for i, page in self._detail_page_cache.items():
+            self.file_repo.save_detail_page(page, i, self.run_id)
+
+    def _get_pages(self, save: bool = False):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(self._get_pages_async(save))
+        else:
+            # Already inside an event loop (e.g. a notebook), so run the crawl
+            # on a loop of its own in a helper thread.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(asyncio.run, self._get_pages_async(save)).result()
 
     def run(
         self, raw_data: bool = False, save: bool = False, filepath: str | None = None
@@ -254,7 +625,8 @@ class FundaScraper(object):
         raw_data:
             If ``True`` the returned dataframe will not be pre-processed.
         save:
-            Save the resulting dataframe to ``filepath`` when ``True``.
+            Save the resulting dataframe to ``filepath`` when ``True``. The
+            fetched html pages are then also stored in the file repository.
         filepath:
             Optional filepath used when ``save`` is ``True``.
         """
@@ -262,11 +634,17 @@ class FundaScraper(object):
         logger.info(f"Started scraping, run_id: {self.run_id}")
 
         logger.info("Fetching pages..")
-        self._get_pages()
+        self._get_pages(save)
+
+        if save:
+            self._save_pages()
 
         logger.info("Extracting data from the html pages")
+        detail_pages = {
+            i: self._detail_page_cache[i] for i in sorted(self._detail_page_cache)
+        }
         df = self.data_extractor.extract_data(
-            self.search_request, self.run_id, not raw_data
+            self.search_request, self.run_id, not raw_data, detail_pages, save
         )
 
         if save:
@@ -1,4 +1,19 @@
-from typing import Optional
+from typing import NamedTuple, Optional
+
+
+class QuerySignature(NamedTuple):
+    """The fields of a :class:`SearchRequest` that make up its query URL."""
+
+    to_buy: bool
+    area: str
+    property_type: Optional[str]
+    find_sold: bool
+    min_price: Optional[int]
+    max_price: Optional[int]
+    days_since: Optional[int]
+    min_floor_area: Optional[str]
+    max_floor_area: Optional[str]
+    sort: Optional[str]
 
 
 class SearchRequest(object):
@@ -106,6 +121,26 @@ class SearchRequest(object):
         else:
             return None
 
+    @property
+    def query_signature(self) -> QuerySignature:
+        """The validated fields that make up the search query URL.
+
+        Requests with equal signatures produce the same URL, so it doubles as a
+        cache key and changes whenever one of the fields is updated.
+        """
+        return QuerySignature(
+            to_buy=self.to_buy,
+            area=self.area,
+            property_type=self.property_type,
+            find_sold=self.find_sold,
+            min_price=self.min_price,
+            max_price=self.max_price,
+            days_since=None if self.days_since is None else self.check_days_since,
+            min_floor_area=self.min_floor_area,
+            max_floor_area=self.max_floor_area,
+            sort=None if self.sort is None else str(self.sort_by),
+        )
+
     def reset(
         self,
         area: Optional[str] = None,
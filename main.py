@@ -16,6 +16,8 @@ if __name__ == "__main__":
     df = scraper.run(clean_data=True)
     # df.head()
 
-    # It's also possible to to extraction separately from fetching the html pages
+    # It's also possible to to extraction separately from fetching the html pages.
+    # The pages are only kept under data/<run_id> when the run is saved, i.e.
+    # scraper.run(save=True)
     # data_extractor = DataExtractor()
     # data_extractor.extract_data(search_params, run_id = "196a5756-8643-11ef-840d-a0510ba6104e", clean_data = True)
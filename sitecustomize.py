@@ -1,3 +1,10 @@
+"""Interpreter start-up shims.
+
+Registers the ``urllib3.packages.six.moves`` alias for urllib3 1.x installs.
+The funda_scraper package does not import urllib3 itself; the alias is kept
+for other tools run from this checkout, and this is the only place it lives.
+"""
+
 import sys
 
 try:
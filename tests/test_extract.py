@@ -0,0 +1,36 @@
+import json
+import os
+
+from funda_scraper.extract import DataExtractor
+from funda_scraper.searchrequest import SearchRequest
+
+
+def detail_page(i: int) -> str:
+    data = {
+        "url": f"https://www.funda.nl/huur/amsterdam/huis-{i}-street/",
+        "description": "A house",
+        "address": {"streetAddress": f"Street {i}", "addressLocality": "amsterdam"},
+        "offers": {"priceCurrency": "EUR", "price": 1500},
+    }
+    return (
+        '<html><body><script type="application/ld+json">'
+        f"{json.dumps(data)}</script></body></html>"
+    )
+
+
+def test_extract_data_from_memory_without_saving(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    search_request = SearchRequest(area="amsterdam", want_to="rent")
+
+    df = DataExtractor().extract_data(
+        search_request,
+        "run-id",
+        clean_data=False,
+        detail_pages={i: detail_page(i) for i in range(3)},
+        save=False,
+    )
+
+    assert df.shape[0] == 3
+    assert list(df["address"]) == ["Street 0", "Street 1", "Street 2"]
+    assert set(df["city"]) == {"amsterdam"}
+    assert os.listdir(tmp_path / "data") == []
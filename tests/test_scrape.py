@@ -1,7 +1,50 @@
+import json
+
+import httpx
 import pytest
 
+from funda_scraper import scrape
 from funda_scraper.preprocess import preprocess_data
-from funda_scraper.scrape import FundaScraper
+from funda_scraper.scrape import FundaScraper, _ListPageLinkParser
+from funda_scraper.searchrequest import QuerySignature
+
+LINKS = [
+    f"https://www.funda.nl/detail/huur/amsterdam/huis-street-{i}/{i}/" for i in range(5)
+]
+
+
+def list_page(links=LINKS, script_type='"application/ld+json"') -> bytes:
+    items = json.dumps({"itemListElement": [{"url": url} for url in links]})
+    return (
+        '<html><head><script type="text/javascript">var a = 1;</script></head>'
+        f"<body>{'<p>filler</p>' * 200}"
+        f"<script type={script_type}>{items}</script>"
+        f"{'<p>tail</p>' * 200}</body></html>"
+    ).encode()
+
+
+def mock_funda(monkeypatch, list_pages, failing=()):
+    """Serves the given list pages by index and fails the ``failing`` links."""
+
+    def handler(request):
+        if "search_result" in request.url.params:
+            page = list_pages[int(request.url.params["search_result"])]
+            return httpx.Response(200, content=page)
+        if str(request.url) in failing:
+            raise httpx.ConnectError("unreachable", request=request)
+        return httpx.Response(200, text=f"<html>{request.url}</html>")
+
+    monkeypatch.setattr(
+        httpx, "AsyncHTTPTransport", lambda **kwargs: httpx.MockTransport(handler)
+    )
+    monkeypatch.setattr(scrape, "BACKOFF_FACTOR", 0)
+
+
+def feed_in_chunks(page: bytes, size: int) -> _ListPageLinkParser:
+    parser = _ListPageLinkParser()
+    for i in range(0, len(page), size):
+        parser.feed(page[i : i + size])
+    return parser
 
 
 class TestFundaScraper(object):
@@ -46,6 +89,139 @@ class TestFundaScraper(object):
             == fixed_link
         )
 
+    def test_query_signature(self, scraper):
+        assert scraper.search_request.query_signature == QuerySignature(
+            to_buy=True,
+            area="amsterdam",
+            property_type=None,
+            find_sold=False,
+            min_price=100000,
+            max_price=500000,
+            days_since=None,
+            min_floor_area=None,
+            max_floor_area=None,
+            sort=None,
+        )
+
+    def test_main_query_url(self, scraper):
+        scraper.reset(property_type="apartment,house", days_since=5, sort="price_up")
+        assert scraper.main_query_url == (
+            "https://www.funda.nl/en/zoeken/koop"
+            "?selected_area=%5B%22amsterdam%22%5D"
+            "&object_type=%5B%22apartment%22,%22house%22%5D"
+            "&price=%22100000-500000%22"
+            "&publication_date=5"
+            "&sort=%22price_up%22"
+        )
+
+    def test_main_query_url_follows_changes(self, scraper):
+        url = scraper.main_query_url
+        assert scraper.main_query_url == url
+
+        scraper.reset(area="rotterdam")
+        assert "%5B%22rotterdam%22%5D" in scraper.main_query_url
+
+        scraper.sort = "date_down"
+        assert scraper.main_query_url.endswith("&sort=%22date_down%22")
+
+        scraper.search_request.find_sold = True
+        assert "&availability=%5B%22unavailable%22%5D" in scraper.main_query_url
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 19, 64, 8192])
+def test_list_page_parser_chunk_sizes(size):
+    parser = feed_in_chunks(list_page(), size)
+    assert parser.links == LINKS
+    assert parser.close() == LINKS
+
+
+def test_list_page_parser_split_marker_and_script_end():
+    page = list_page()
+    marker = page.index(b"application/ld+json")
+    script_end = page.index(b"</script>", marker)
+    chunks = [
+        page[: marker + 5],
+        page[marker + 5 : script_end + 3],
+        page[script_end + 3 :],
+    ]
+
+    parser = _ListPageLinkParser()
+    assert parser.feed(chunks[0]) is None
+    assert parser.feed(chunks[1]) is None
+    assert parser.feed(chunks[2]) == LINKS
+
+
+def test_list_page_parser_keep_page():
+    page = list_page()
+    parser = _ListPageLinkParser(keep_page=True)
+    for i in range(0, len(page), 100):
+        parser.feed(page[i : i + 100])
+    assert parser.close() == LINKS
+    assert parser.page == page
+
+
+def test_list_page_parser_falls_back_to_lxml():
+    parser = feed_in_chunks(list_page(script_type="'application/ld+json'"), 64)
+    assert parser.links is None
+    assert parser.close() == LINKS
+
+
+def test_list_page_parser_skips_false_marker():
+    page = list_page().replace(
+        b"var a = 1;", b'var t = "application/ld+json";', 1
+    )
+    parser = feed_in_chunks(page, 64)
+    assert parser.links == LINKS
+    assert parser.close() == LINKS
+
+
+@pytest.mark.parametrize(
+    "page",
+    [b"<html><body><p>No results</p></body></html>", b"", b"   \n", b"<!-- x -->"],
+)
+def test_list_page_parser_without_json_ld(page):
+    parser = feed_in_chunks(page, 8)
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+def test_get_pages(monkeypatch):
+    fixed = [FundaScraper.fix_link(link) for link in LINKS]
+    first_page = list_page(LINKS[:3] + ["https://www.funda.nl/not-a-detail-link/"])
+    second_page = list_page(LINKS[2:])
+    mock_funda(monkeypatch, {1: first_page, 2: second_page}, failing=[fixed[3]])
+
+    scraper = FundaScraper(area="amsterdam", want_to="rent", number_of_pages=2)
+    scraper._get_pages(save=True)
+
+    # Duplicates and the broken link are dropped, the failed page is skipped.
+    assert scraper.links == fixed[:3] + fixed[4:]
+    assert scraper._detail_page_cache == {
+        i: f"<html>{fixed[i]}</html>" for i in (0, 1, 2, 4)
+    }
+    assert scraper._list_page_cache == {
+        1: first_page.decode(),
+        2: second_page.decode(),
+    }
+
+
+def test_get_pages_without_save(monkeypatch):
+    mock_funda(monkeypatch, {1: list_page()})
+
+    scraper = FundaScraper(area="amsterdam", want_to="rent")
+    scraper._get_pages()
+
+    assert scraper.links == [FundaScraper.fix_link(link) for link in LINKS]
+    assert scraper._list_page_cache == {}
+
+
+def test_get_pages_stops_when_a_list_page_fails(monkeypatch):
+    mock_funda(monkeypatch, {1: list_page(), 2: b"<html><p>No results</p></html>"})
+
+    scraper = FundaScraper(area="amsterdam", want_to="rent", number_of_pages=2)
+    with pytest.raises(ValueError):
+        scraper._get_pages()
+
 
 def test_rent():
     scraper = FundaScraper(